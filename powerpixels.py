@@ -7,69 +7,188 @@ Written by Guido Meijer
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+from scipy.signal import welch, iirnotch, filtfilt
 
 import os
-from os.path import join, isfile, split, isdir, dirname, realpath
+from os.path import realpath
 from pathlib import Path
 import shutil
-from glob import glob
 import json
+from functools import lru_cache
+from collections import defaultdict
+from copy import deepcopy
 
 import spikeinterface.full as si
+from spikeinterface.preprocessing.basepreprocessor import BasePreprocessor, BasePreprocessorSegment
 
 from one.api import ONE
-from neuropixel import NP2Converter
-from atlaselectrophysiology.extract_files import extract_rmsmap
-from brainbox.metrics.single_units import spike_sorting_metrics
-from ibllib.ephys import ephysqc
-from ibllib.ephys.spikes import ks2_to_alf, sync_spike_sorting
-from ibllib.pipes.ephys_tasks import (EphysCompressNP1, EphysCompressNP21, EphysSyncPulses,
-                                      EphysSyncRegisterRaw, EphysPulses)
 
+# The IBL and plotting modules are imported inside the steps which use them to keep the 
+# startup of the pipeline fast
+
+
+def _load_json(path):
+    """
+    Load a JSON file, parsing it only once for as long as the file is not modified on disk.
+
+    Parameters
+    ----------
+    path : str or Path
+        Full path to the JSON file.
+
+    Returns
+    -------
+    dict
+        Copy of the loaded dictionary, changing it does not affect the cached version.
+
+    """
+    return deepcopy(_load_json_cached(realpath(path), os.stat(path).st_mtime_ns))
+
+
+@lru_cache(maxsize=32)
+def _load_json_cached(path, mtime):
+    # mtime is only part of the cache key, a changed file results in a fresh load
+    with open(path, 'r') as openfile:
+        return json.load(openfile)
+
+
+def _scan_folder(folder):
+    """
+    List the files in a folder with a single directory scan and index them by their last two
+    suffixes, for example 'name.imec0.ap.bin' is indexed under '.ap.bin'.
+
+    Parameters
+    ----------
+    folder : Path
+        Path to the folder to scan.
+
+    Returns
+    -------
+    files : defaultdict
+        Dictionary with the suffixes as keys and lists of file paths as values, suffixes which
+        are not present return an empty list.
+
+    """
+    files = defaultdict(list)
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file():
+                files[''.join(Path(entry.name).suffixes[-2:])].append(Path(entry.path))
+    return files
+
+
+def _plot_psd(data_chunk, fs, save_path):
+    """
+    Plot the power spectral density of all channels and save the figure to disk. 
+    The PSDs of all channels are computed in one go and the traces are rasterized.
+
+    Parameters
+    ----------
+    data_chunk : 2D array
+        Chunk of data (samples x channels).
+    fs : float
+        Sampling frequency.
+    save_path : Path
+        Path to where the figure will be saved.
+
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    
+    f, p = welch(data_chunk, fs=fs, axis=0, nperseg=1024)
+    fig, ax = plt.subplots(figsize=(10, 7))
+    ax.semilogy(f, p, color='b', linewidth=0.3, rasterized=True)
+    ax.set(xlabel='Frequency (Hz)', ylabel='Power spectral density')
+    plt.savefig(save_path, dpi=150)
+    plt.close(fig)
+    
+    return
+
+
+class CachedTracesRecording(BasePreprocessor):
+    """
+    Recording which keeps every chunk of traces it has read in memory, so that requesting the
+    same chunk again does not re-run the lazy preprocessing chain. Only meant for a limited
+    number of chunks, such as the random chunks used for bad channel detection.
+
+    """
+    
+    def __init__(self, recording):
+        BasePreprocessor.__init__(self, recording)
+        for parent_segment in recording._recording_segments:
+            self.add_recording_segment(CachedTracesRecordingSegment(parent_segment))
+        self._kwargs = dict(recording=recording)
+        
+        
+class CachedTracesRecordingSegment(BasePreprocessorSegment):
+    
+    def __init__(self, parent_recording_segment):
+        BasePreprocessorSegment.__init__(self, parent_recording_segment)
+        self._cache = dict()
+        
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        if channel_indices is None or isinstance(channel_indices, slice):
+            key = (start_frame, end_frame, str(channel_indices))
+        else:
+            key = (start_frame, end_frame, tuple(channel_indices))
+        if key not in self._cache:
+            self._cache[key] = self.parent_recording_segment.get_traces(
+                start_frame, end_frame, channel_indices)
+        return self._cache[key].copy()
+                
 
 class Pipeline:
     
-    def __init__(self):
+    def __init__(self, n_jobs=None, init_one=True):
+        """
+        Parameters
+        ----------
+        n_jobs : int, optional
+            Number of parallel jobs SpikeInterface can use. The default is None which uses
+            N_CORES from the settings.
+        init_one : bool, optional
+            Whether to set up the ONE connection. The default is True, worker processes set this
+            to False because the main process already did the setup before starting them.
+
+        """
         
         # Load in setting files
-        with open(join(dirname(realpath(__file__)), 'settings.json'), 'r') as openfile:
-            self.settings = json.load(openfile)
-        with open(join(dirname(realpath(__file__)), 'wiring_files', 'nidq.wiring.json'), 'r') as openfile:
-            self.nidq_sync = json.load(openfile)
-        with open(join(dirname(realpath(__file__)), 'wiring_files',
-                       f'{self.nidq_sync["SYSTEM"]}.wiring.json'), 'r') as openfile:
-            self.probe_sync = json.load(openfile)
+        repo_path = Path(realpath(__file__)).parent
+        self.settings = _load_json(repo_path / 'settings.json')
+        self.nidq_sync = _load_json(repo_path / 'wiring_files' / 'nidq.wiring.json')
+        self.probe_sync = _load_json(repo_path / 'wiring_files' / f'{self.nidq_sync["SYSTEM"]}.wiring.json')
 
         # Initialize spikeinterface parallel processing
-        si.set_global_job_kwargs(n_jobs=self.settings['N_CORES'], progress_bar=True)
+        if n_jobs is None:
+            n_jobs = self.settings['N_CORES']
+        self.n_jobs = n_jobs
+        si.set_global_job_kwargs(n_jobs=self.n_jobs, progress_bar=True)
         
         # Load in spike sorting parameters
-        if isfile(join(dirname(realpath(__file__)), 'spikesorter_param_files',
-                       f'{self.settings["SPIKE_SORTER"]}_params.json')):
-            with open(join(dirname(realpath(__file__)), 'spikesorter_param_files',
-                           f'{self.settings["SPIKE_SORTER"]}_params.json'), 'r') as openfile:
-                self.sorter_params = json.load(openfile)
+        sorter_params_file = (repo_path / 'spikesorter_param_files'
+                              / f'{self.settings["SPIKE_SORTER"]}_params.json')
+        if sorter_params_file.is_file():
+            self.sorter_params = _load_json(sorter_params_file)
         else:
             self.sorter_params = si.get_default_sorter_params(self.settings['SPIKE_SORTER'])
             
         # Initialize ONE connection (needed for some IBL steps for some reason)
-        ONE.setup(base_url='https://openalyx.internationalbrainlab.org', silent=True)
-        one = ONE(password='international')
+        if init_one:
+            ONE.setup(base_url='https://openalyx.internationalbrainlab.org', silent=True)
+            one = ONE(password='international')
             
         
     def set_probe_paths(self, probe_path):
         
-        self.probe_path = probe_path
-        self.sorter_out_path = Path(join(
-            probe_path,
-            self.settings['SPIKE_SORTER'] + self.settings['IDENTIFIER'],
-            'sorter_output')
-            )
-        self.this_probe = split(probe_path)[1]
-        self.results_path = Path(join(self.session_path,
-                                      self.this_probe + self.settings['IDENTIFIER']))
-        self.ap_file = Path(glob(join(self.probe_path, '*ap.*bin'))[0])
+        self.probe_path = Path(probe_path)
+        self.sorter_out_path = (self.probe_path
+                                / (self.settings['SPIKE_SORTER'] + self.settings['IDENTIFIER'])
+                                / 'sorter_output')
+        self.this_probe = self.probe_path.name
+        self.results_path = self.session_path / (self.this_probe + self.settings['IDENTIFIER'])
+        self.probe_files = _scan_folder(self.probe_path)
+        self.ap_file = (self.probe_files['.ap.bin'] + self.probe_files['.ap.cbin'])[0]
             
         return
     
@@ -81,23 +200,30 @@ class Pipeline:
         """
         
         # Restructure file and folders
-        if len([i for i in os.listdir(join(self.session_path, 'raw_ephys_data')) if i[:5] == 'probe']) == 0:
-            if len(os.listdir(join(self.session_path, 'raw_ephys_data'))) == 0:
+        raw_path = self.session_path / 'raw_ephys_data'
+        raw_contents = os.listdir(raw_path)
+        if len([i for i in raw_contents if i[:5] == 'probe']) == 0:
+            if len(raw_contents) == 0:
                 print('No ephys data found')
                 return
-            elif len(os.listdir(join(self.session_path, 'raw_ephys_data'))) > 1:
+            elif len(raw_contents) > 1:
                 print('More than one run found, not supported')
                 return 
-            orig_dir = os.listdir(join(self.session_path, 'raw_ephys_data'))[0]
+            orig_dir = raw_contents[0]
             if orig_dir[-2] != 'g':
                 print('Recording is not in SpikeGLX format, skipping file restructuring')
                 return
-            for i, this_dir in enumerate(os.listdir(join(self.session_path, 'raw_ephys_data', orig_dir))):
-                shutil.move(join(self.session_path, 'raw_ephys_data', orig_dir, this_dir),
-                            join(self.session_path, 'raw_ephys_data'))
-            os.rmdir(join(self.session_path, 'raw_ephys_data', orig_dir))
-            for i, this_path in enumerate(glob(join(self.session_path, 'raw_ephys_data', '*imec*'))):
-                os.rename(this_path, join(self.session_path, 'raw_ephys_data', 'probe0' + this_path[-1]))
+            # Move everything up one level, renaming imec folders to probe0X on the way. Take a 
+            # snapshot of the entries first, renaming while scanning can skip entries on network drives
+            with os.scandir(raw_path / orig_dir) as entries:
+                entries = list(entries)
+            for entry in entries:
+                if 'imec' in entry.name:
+                    new_name = 'probe0' + entry.name[-1]
+                else:
+                    new_name = entry.name
+                os.rename(entry.path, raw_path / new_name)
+            os.rmdir(raw_path / orig_dir)
         return
     
     
@@ -106,18 +232,25 @@ class Pipeline:
         Create synchronization file for the nidq
 
         """
+        from ibllib.pipes.ephys_tasks import EphysSyncRegisterRaw
         
         # Create synchronization file
         nidq_file = next(self.session_path.joinpath('raw_ephys_data').glob('*.nidq.*bin'))
-        with open(nidq_file.with_suffix('.wiring.json'), 'w') as fp:
-            json.dump(self.nidq_sync, fp, indent=1)
+        nidq_file.with_suffix('.wiring.json').write_bytes(
+            json.dumps(self.nidq_sync, indent=1).encode())
         
+        # Serialize the probe wiring once, it is the same for all probes
+        probe_blob = json.dumps(self.probe_sync, indent=1).encode()
         for ap_file in self.session_path.joinpath('raw_ephys_data').rglob('*.ap.cbin'):
-            with open(ap_file.with_suffix('.wiring.json'), 'w') as fp:
-                json.dump(self.probe_sync, fp, indent=1)
+            ap_file.with_suffix('.wiring.json').write_bytes(probe_blob)
         
-        # Create nidq sync file        
-        EphysSyncRegisterRaw(session_path=self.session_path, sync_collection='raw_ephys_data').run()
+        # Create nidq sync file, skip if this was already done in a previous run
+        sync_done_file = self.session_path / 'raw_ephys_data' / '.nidq_sync_done'
+        if not sync_done_file.exists():
+            status = EphysSyncRegisterRaw(session_path=self.session_path,
+                                          sync_collection='raw_ephys_data').run()
+            if status == 0:
+                sync_done_file.touch()
         
         return
                 
@@ -142,15 +275,16 @@ class Pipeline:
         """
         
         # Load in recording
-        if len(glob(join(self.probe_path, '*.cbin'))) > 0:
+        if self.probe_files['.ap.cbin']:
             # Recording is already compressed by a previous run, loading in compressed data
             rec = si.read_cbin_ibl(self.probe_path)
         else:
-            rec = si.read_spikeglx(self.probe_path, stream_id=f'imec{split(self.probe_path)[-1][-1]}.ap')
+            rec = si.read_spikeglx(self.probe_path, stream_id=f'imec{self.this_probe[-1]}.ap')
         
-        # Apply high-pass filter
+        # Apply high-pass filter, keep the data in int16 like the raw data (all downstream steps
+        # inherit this dtype) which halves the memory bandwidth compared to float32
         print('\nApplying high-pass filter.. ')
-        rec_filtered = si.highpass_filter(rec, ftype='bessel', dtype='float32')
+        rec_filtered = si.highpass_filter(rec, ftype='bessel', dtype='int16')
                     
         # Correct for inter-sample phase shift
         print('Correcting for phase shift.. ')
@@ -159,11 +293,16 @@ class Pipeline:
         # Detect and interpolate over bad channels
         print('Detecting and interpolating over bad channels.. ')
         
+        # Both bad channel detections sample the same random chunks, keep the filtered chunks in 
+        # memory so that they are only read and filtered once
+        rec_cached = CachedTracesRecording(rec_filtered)
+        chunk_kwargs = dict(chunk_duration_s=0.3, num_random_chunks=100, seed=42)
+        
         # Do common average referencing before detecting bad channels
-        rec_comref = si.common_reference(rec_filtered)
+        rec_comref = si.common_reference(rec_cached)
         
         # Detect dead channels
-        bad_channel_ids, all_channels = si.detect_bad_channels(rec_filtered, seed=42)
+        bad_channel_ids, all_channels = si.detect_bad_channels(rec_cached, **chunk_kwargs)
         prec_dead_ch = np.sum(all_channels == 'dead') / all_channels.shape[0]
         print(f'{np.sum(all_channels == "dead")} ({prec_dead_ch*100:.0f}%) dead channels')
         dead_channel_ids = rec_filtered.get_channel_ids()[all_channels == 'dead']
@@ -173,10 +312,11 @@ class Pipeline:
         
         # Detect noisy channels
         bad_channel_ids, all_channels = si.detect_bad_channels(rec_comref, method='mad',
-                                                               std_mad_threshold=3, seed=42)
+                                                               std_mad_threshold=3, **chunk_kwargs)
         prec_noise_ch = np.sum(all_channels == 'noise') / all_channels.shape[0]
         print(f'{np.sum(all_channels == "noise")} ({prec_noise_ch*100:.0f}%) noise channels')
         noisy_channel_ids = rec_comref.get_channel_ids()[all_channels == 'noise']
+        del rec_cached, rec_comref
         
         # Remove channels that are outside of the brain
         rec_no_out = rec_shifted.remove_channels(remove_channel_ids=out_channel_ids)
@@ -188,7 +328,8 @@ class Pipeline:
         # Destripe when there is one shank, CAR when there are four shanks
         if np.unique(rec_interpolated.get_property('group')).shape[0] == 1:
             print('Single shank recording; destriping')
-            rec_processed = si.highpass_spatial_filter(rec_interpolated)
+            # The automatic gain control of the destriping does not work on integer data
+            rec_processed = si.highpass_spatial_filter(si.astype(rec_interpolated, 'float32'))
         else:
             print('Multi shank recording; common average reference')
             rec_processed = si.common_reference(rec_interpolated)
@@ -197,17 +338,14 @@ class Pipeline:
         print('Calculating power spectral density')
         data_chunk = si.get_random_data_chunks(rec_processed, num_chunks_per_segment=1,
                                                chunk_size=30000, seed=42)
-        fig, ax = plt.subplots(figsize=(10, 7))
-        for tr in data_chunk.T:
-            p, f = ax.psd(tr, Fs=rec_processed.sampling_frequency, color="b")
-        plt.savefig(join(self.probe_path, 'power spectral density.jpg'), dpi=600)
+        _plot_psd(data_chunk, rec_processed.sampling_frequency,
+                  self.probe_path / 'power spectral density.jpg')
         
         # Apply notch filter 
-        if isfile(join(self.probe_path, 'notch_filter.json')):
+        if (self.probe_path / 'notch_filter.json').is_file():
             
             # Load in notch filter settings
-            with open(join(self.probe_path, 'notch_filter.json'), 'r') as openfile:
-                notch_filter = json.load(openfile)
+            notch_filter = _load_json(self.probe_path / 'notch_filter.json')
                 
             # Apply filters
             rec_notch = rec_processed
@@ -215,14 +353,14 @@ class Pipeline:
                 print(f'Applying notch filter at {freq} Hz..')
                 rec_notch = si.notch_filter(rec_notch, freq=freq, q=q)
                 
-            # Plot spectral density
+            # Plot spectral density, apply the notch filters to the chunk that was already loaded
+            # instead of running the whole preprocessing chain on it again
             print('Calculating power spectral density')
-            data_chunk = si.get_random_data_chunks(rec_notch, num_chunks_per_segment=1,
-                                                   chunk_size=30000, seed=42)
-            fig, ax = plt.subplots(figsize=(10, 7))
-            for tr in data_chunk.T:
-                p, f = ax.psd(tr, Fs=rec_processed.sampling_frequency, color="b")
-            plt.savefig(join(self.probe_path, 'power spectral density after notch filter.jpg'), dpi=600)
+            for freq, q in zip(notch_filter['FREQ'], notch_filter['Q']):
+                b, a = iirnotch(freq, q, fs=rec_processed.sampling_frequency)
+                data_chunk = filtfilt(b, a, data_chunk, axis=0)
+            _plot_psd(data_chunk, rec_processed.sampling_frequency,
+                      self.probe_path / 'power spectral density after notch filter.jpg')
             
             rec_final = rec_notch
         else:
@@ -231,6 +369,34 @@ class Pipeline:
         return rec_final
     
     
+    def save_binary(self, rec):
+        """
+        Write the preprocessed recording to an int16 binary file which the sorter reads 
+        directly instead of copying it to its own recording.dat. Call this right before the 
+        spike sorting, inside the sorting semaphore, so that the binary files of several probes 
+        don't pile up on disk. The binary file is only meant for the spike sorting and can be 
+        deleted afterwards.
+
+        Parameters
+        ----------
+        rec : SpikeInterface recording object
+            The preprocessed recording.
+
+        Returns
+        -------
+        rec_bin : SpikeInterface recording object
+            The preprocessed recording backed by the binary file in the preproc_bin folder.
+
+        """
+        
+        print('Saving preprocessed recording to binary file..')
+        rec_bin = rec.save(folder=self.probe_path / 'preproc_bin', format='binary',
+                           dtype='int16', n_jobs=self.n_jobs,
+                           chunk_duration='1s', progress_bar=False, overwrite=True)
+        
+        return rec_bin
+    
+    
     def spikesorting(self, rec, probe_path):
         """
         Run spike sorting using SpikeInterface
@@ -247,7 +413,7 @@ class Pipeline:
             sort = si.run_sorter(
                 self.settings['SPIKE_SORTER'],
                 rec,
-                folder=join(probe_path, self.settings['SPIKE_SORTER']),
+                folder=Path(probe_path) / self.settings['SPIKE_SORTER'],
                 verbose=True,
                 docker_image=self.settings['USE_DOCKER'],
                 **self.sorter_params)
@@ -255,13 +421,12 @@ class Pipeline:
             
             # Log error to disk
             print(err)
-            logf = open(os.path.join(probe_path, 'error_log.txt'), 'w')
-            logf.write(str(err))
-            logf.close()
+            (Path(probe_path) / 'error_log.txt').write_text(str(err))
             
             # Delete empty sorting directory
-            if isdir(join(probe_path, self.settings['SPIKE_SORTER'] + self.settings['IDENTIFIER'])):
-                shutil.rmtree(join(probe_path, self.settings['SPIKE_SORTER'] + self.settings['IDENTIFIER']))
+            sorter_path = Path(probe_path) / (self.settings['SPIKE_SORTER'] + self.settings['IDENTIFIER'])
+            if sorter_path.is_dir():
+                shutil.rmtree(sorter_path)
             
             return None
         
@@ -281,7 +446,7 @@ class Pipeline:
 
         """
         
-        if isdir(join(self.results_path, 'sorting')):
+        if (self.results_path / 'sorting').is_dir():
             return
         
         # Create a sorting analyzer and save to disk as folder
@@ -289,7 +454,7 @@ class Pipeline:
             sorting=sort,
             recording=rec,
             format='binary_folder',
-            folder=join(self.results_path, 'sorting'),
+            folder=self.results_path / 'sorting',
             overwrite=True
             )           
         
@@ -329,9 +494,12 @@ class Pipeline:
         Calculate raw ephys QC metrics such as AP band RMS and LFP power per channel
         
         """
+        from neuropixel import NP2Converter
+        from atlaselectrophysiology.extract_files import extract_rmsmap
+        from ibllib.ephys import ephysqc
         
         # If there is no LF file (NP2 probes), generate it
-        if len(glob(join(self.probe_path, '*lf.*bin'))) == 0:
+        if not (self.probe_files['.lf.bin'] or self.probe_files['.lf.cbin']):
             print('Generating LFP bin file (can take a while)')
             conv = NP2Converter(self.ap_file, compress=False)
             conv._process_NP21(assert_shanks=False)
@@ -340,16 +508,18 @@ class Pipeline:
             NP2_probe = False
                                     
         # Compute raw ephys QC metrics
-        if not isfile(join(self.probe_path, '_iblqc_ephysSpectralDensityAP.power.npy')):
+        if not (self.probe_path / '_iblqc_ephysSpectralDensityAP.power.npy').is_file():
             task = ephysqc.EphysQC('', session_path=self.session_path, use_alyx=False)
             task.probe_path = self.probe_path
             task.run()                
             extract_rmsmap(self.ap_file, out_folder=self.probe_path, spectra=False)
         
         # If an LF bin file was generated, delete it (results in errors down the line)
-        if NP2_probe and len(glob(join(self.probe_path, '*lf.*bin'))) == 1:
-            os.remove(glob(join(self.probe_path, '*lf.*bin'))[0])
-            os.remove(glob(join(self.probe_path, '*lf.*meta'))[0])
+        probe_files = _scan_folder(self.probe_path)
+        lf_files = probe_files['.lf.bin'] + probe_files['.lf.cbin']
+        if NP2_probe and len(lf_files) == 1:
+            os.remove(lf_files[0])
+            os.remove(probe_files['.lf.meta'][0])
                 
         return
     
@@ -361,23 +531,23 @@ class Pipeline:
         https://int-brain-lab.github.io/iblenv/docs_external/alf_intro.html
 
         """        
+        from ibllib.ephys.spikes import ks2_to_alf
         
         # Set the dat_file path correctly in params.py before conversion         
-        with open(join(self.sorter_out_path, 'params.py'), 'r') as file:
+        with open(self.sorter_out_path / 'params.py', 'r') as file:
             lines = file.readlines()
         lines[-1] = f"dat_path = '{self.ap_file}'\n"
-        with open(join(self.sorter_out_path, 'params.py'), 'w') as file:
+        with open(self.sorter_out_path / 'params.py', 'w') as file:
             file.writelines(lines)
             
         # Export as ALF files
-        if not isdir(self.results_path):
+        if not self.results_path.is_dir():
             os.mkdir(self.results_path)
         ks2_to_alf(self.sorter_out_path, self.probe_path, self.results_path, bin_file=self.ap_file)
         
         # Move LFP power etc. to the alf folder
-        qc_files = glob(join(self.probe_path, '_iblqc_*'))
-        for ii, this_file in enumerate(qc_files):
-            shutil.move(this_file, join(self.results_path, split(this_file)[1]))
+        for this_file in self.probe_path.glob('_iblqc_*'):
+            shutil.move(this_file, self.results_path / this_file.name)
         
         return
             
@@ -399,14 +569,16 @@ class Pipeline:
         None.
 
         """
+        from brainbox.metrics.single_units import spike_sorting_metrics
         
         # Get kilosort good indication 
-        ks_metric = pd.read_csv(join(self.sorter_out_path, 'cluster_KSLabel.tsv'), sep='\t')
+        ks_metric = pd.read_csv(self.sorter_out_path / 'cluster_KSLabel.tsv', sep='\t',
+                                engine='pyarrow', usecols=['KSLabel'])
         
         if hasattr(si, 'auto_label_units'):
             
             # Load in recording
-            sorting_analyzer = si.load_sorting_analyzer(join(self.results_path, 'sorting'))
+            sorting_analyzer = si.load_sorting_analyzer(self.results_path / 'sorting')
                      
             # Apply the sua/mua model
             ml_labels = si.auto_label_units(
@@ -431,8 +603,8 @@ class Pipeline:
                                                  spikes['amps'], spikes['depths'])
         
         # Add to quality metrics
-        qc_metrics = pd.read_csv(join(self.results_path, 'sorting', 'extensions', 'quality_metrics',
-                                      'metrics.csv'), index_col=0)
+        metrics_file = self.results_path / 'sorting' / 'extensions' / 'quality_metrics' / 'metrics.csv'
+        qc_metrics = pd.read_csv(metrics_file, index_col=0)
         qc_metrics['KS_label'] = (ks_metric['KSLabel'] == 'good').astype(int)
         qc_metrics.insert(0, 'KS_label', qc_metrics.pop('KS_label'))
         qc_metrics['IBL_label'] = df_units['label']
@@ -441,17 +613,15 @@ class Pipeline:
         qc_metrics.insert(0, 'ML_label', qc_metrics.pop('ML_label'))
         
         # Save to disk
-        qc_metrics.to_csv(join(
-            self.results_path, 'sorting', 'extensions', 'quality_metrics', 'metrics.csv'))
-        np.save(join(self.results_path, 'clusters.IBLLabel.npy'), qc_metrics['IBL_label'])
-        np.save(join(self.results_path, 'clusters.KSLabel.npy'), qc_metrics['KS_label'])
-        np.save(join(self.results_path, 'clusters.MLLabel.npy'), qc_metrics['ML_label'])
-        if isfile(join(self.results_path, 'cluster_KSLabel.tsv')):
-            os.remove(join(self.results_path, 'cluster_KSLabel.tsv'))
+        qc_metrics.to_csv(metrics_file)
+        np.save(self.results_path / 'clusters.IBLLabel.npy', qc_metrics['IBL_label'])
+        np.save(self.results_path / 'clusters.KSLabel.npy', qc_metrics['KS_label'])
+        np.save(self.results_path / 'clusters.MLLabel.npy', qc_metrics['ML_label'])
+        if (self.results_path / 'cluster_KSLabel.tsv').is_file():
+            os.remove(self.results_path / 'cluster_KSLabel.tsv')
         
         # Copy quality metrics to output folder
-        shutil.copy(join(self.results_path, 'sorting', 'extensions', 'quality_metrics', 'metrics.csv'),
-                    join(self.results_path, 'clusters.metrics.csv'))
+        shutil.copy(metrics_file, self.results_path / 'clusters.metrics.csv')
         
         return
         
@@ -461,30 +631,45 @@ class Pipeline:
         Synchronize spikes of this probe to the nidq base station
 
         """
+        from ibllib.ephys.spikes import sync_spike_sorting
+        from ibllib.pipes.ephys_tasks import EphysSyncPulses, EphysPulses
        
-        # Create probe sync file
-        task = EphysSyncPulses(session_path=self.session_path, sync='nidq', pname=self.this_probe,
-                               sync_ext='bin', sync_namespace='spikeglx',
+        # Create probe sync file, skip if this was already done in a previous run
+        sync_done_file = self.session_path / 'raw_ephys_data' / f'.{self.this_probe}_sync_done'
+        if not sync_done_file.exists():
+            task = EphysSyncPulses(session_path=self.session_path, sync='nidq', pname=self.this_probe,
+                                   sync_ext='bin', sync_namespace='spikeglx',
+                                   sync_collection='raw_ephys_data',
+                                   device_collection='raw_ephys_data')
+            status_sync = task.run()
+            task = EphysPulses(session_path=self.session_path, pname=self.this_probe,
                                sync_collection='raw_ephys_data',
                                device_collection='raw_ephys_data')
-        task.run()
-        task = EphysPulses(session_path=self.session_path, pname=self.this_probe,
-                           sync_collection='raw_ephys_data',
-                           device_collection='raw_ephys_data')
-        task.run()
+            status_pulses = task.run()
+            if status_sync == 0 and status_pulses == 0:
+                sync_done_file.touch()
         
         # Synchronize spike sorting to nidq clock
         sync_spike_sorting(self.ap_file, self.results_path)
         
         # Extract digital sync timestamps
-        sync_times = np.load(join(self.session_path, 'raw_ephys_data', '_spikeglx_sync.times.npy'))
-        sync_polarities = np.load(join(self.session_path, 'raw_ephys_data', '_spikeglx_sync.polarities.npy'))
-        sync_channels = np.load(join(self.session_path, 'raw_ephys_data', '_spikeglx_sync.channels.npy'))
+        raw_path = self.session_path / 'raw_ephys_data'
+        # Memory map the sync arrays so that only the samples of the wired channels are read
+        sync_times = np.load(raw_path / '_spikeglx_sync.times.npy', mmap_mode='r')
+        sync_polarities = np.load(raw_path / '_spikeglx_sync.polarities.npy', mmap_mode='r')
+        sync_channels = np.load(raw_path / '_spikeglx_sync.channels.npy', mmap_mode='r')
+        
+        # Sort once by channel so that each channel is a contiguous slice
+        order = np.argsort(sync_channels, kind='stable')
+        ch_sorted = sync_channels[order]
         for ii, ch_name in enumerate(self.nidq_sync['SYNC_WIRING_DIGITAL'].keys()):
             if ch_name == 'imec_sync':
                 continue
-            nidq_pulses = sync_times[(sync_channels == int(ch_name[-1])) & (sync_polarities == 1)]
-            np.save(join(self.session_path, self.nidq_sync['SYNC_WIRING_DIGITAL'][ch_name] + '.times.npy'),
+            ch_id = int(ch_name[-1])
+            lo, hi = np.searchsorted(ch_sorted, [ch_id, ch_id + 1])
+            ch_idx = order[lo:hi]
+            nidq_pulses = sync_times[ch_idx][sync_polarities[ch_idx] == 1]
+            np.save(self.session_path / (self.nidq_sync['SYNC_WIRING_DIGITAL'][ch_name] + '.times.npy'),
                     nidq_pulses)
         return
         
@@ -495,17 +680,19 @@ class Pipeline:
         After compression the file will be a .cbin file instead of .bin
         
         """
+        from ibllib.pipes.ephys_tasks import EphysCompressNP1
         
         # Load in recording to see if it's NP1 one shank or NP2 four shank
-        if len(glob(join(self.probe_path, '*.cbin'))) > 0:
+        probe_files = _scan_folder(self.probe_path)
+        if probe_files['.ap.cbin']:
             # Recording is already compressed by a previous run, loading in compressed data
             rec = si.read_cbin_ibl(self.probe_path)
         else:
-            rec = si.read_spikeglx(self.probe_path, stream_id=f'imec{split(self.probe_path)[-1][-1]}.ap')
+            rec = si.read_spikeglx(self.probe_path, stream_id=f'imec{self.this_probe[-1]}.ap')
         
 
         if self.settings['COMPRESS_RAW_DATA']:
-            if len(glob(join(self.session_path, 'raw_ephys_data', self.this_probe, '*ap.cbin'))) == 0:
+            if not probe_files['.ap.cbin']:
                 print('Compressing raw binary file')
                 if np.unique(rec.get_property('group')).shape[0] == 1:
                     task = EphysCompressNP1(session_path=self.session_path, pname=self.this_probe)
@@ -514,12 +701,12 @@ class Pipeline:
                     print('Cannot compress four shank probe recordings yet')
                     return
                 task.run()
+                probe_files = _scan_folder(self.probe_path)
                 
             # Delete original raw data
-            if ((len(glob(join(self.session_path, 'raw_ephys_data', self.this_probe, '*ap.cbin'))) == 0)
-                and (len(glob(join(self.session_path, 'raw_ephys_data', self.this_probe, '*ap.bin'))) == 1)):
+            if not probe_files['.ap.cbin'] and len(probe_files['.ap.bin']) == 1:
                 try:
-                    os.remove(glob(join(self.session_path, 'raw_ephys_data', self.this_probe, '*ap.bin'))[0])
+                    os.remove(probe_files['.ap.bin'][0])
                 except:
                     print('Could not remove uncompressed ap bin file, delete manually')
                     return
@@ -541,24 +728,26 @@ def manual_curation(results_path):
 
     """
     
+    results_path = Path(results_path)
+    
     # Load in sorting analyzer from disk
-    sorting_analyzer = si.load_sorting_analyzer(join(results_path, 'sorting'))
+    sorting_analyzer = si.load_sorting_analyzer(results_path / 'sorting')
     
     # Launch manual curation GUI            
     _ = si.plot_sorting_summary(sorting_analyzer=sorting_analyzer, curation=True,
                                 backend='spikeinterface_gui')
     
     # Extract manual curation labels and save in results folder
-    if isfile(join(results_path, 'sorting', 'spikeinterface_gui', 'curation_data.json')):
-        with open(join(results_path, 'sorting', 'spikeinterface_gui', 'curation_data.json')) as f:
+    if (results_path / 'sorting' / 'spikeinterface_gui' / 'curation_data.json').is_file():
+        with open(results_path / 'sorting' / 'spikeinterface_gui' / 'curation_data.json') as f:
             label_dict = json.load(f)
-        if isfile(join(results_path, 'clusters.manualLabels.npy')):
-            manual_labels = np.load(join(results_path, 'clusters.manualLabels.npy'))
+        if (results_path / 'clusters.manualLabels.npy').is_file():
+            manual_labels = np.load(results_path / 'clusters.manualLabels.npy')
         else:
             manual_labels = np.array(['no label'] * sorting_analyzer.unit_ids.shape[0])
         for this_unit in label_dict['manual_labels']:
             manual_labels[sorting_analyzer.unit_ids == this_unit['unit_id']] = this_unit['quality']
-        np.save(join(results_path, 'clusters.manualLabels.npy'), manual_labels)
+        np.save(results_path / 'clusters.manualLabels.npy', manual_labels)
     
     return       
             
@@ -590,40 +779,42 @@ def load_neural_data(session_path, probe, histology=True, only_good=True):
         A dictionary containing data per channel 
     """
     
+    probe_path = Path(session_path) / probe
+    
     # Load in spiking data
     spikes = dict()
-    spikes['times'] = np.load(join(session_path, probe, 'spikes.times.npy'))
-    spikes['clusters'] = np.load(join(session_path, probe, 'spikes.clusters.npy'))
-    spikes['amps'] = np.load(join(session_path, probe, 'spikes.amps.npy'))
-    spikes['depths'] = np.load(join(session_path, probe, 'spikes.depths.npy'))
+    spikes['times'] = np.load(probe_path / 'spikes.times.npy')
+    spikes['clusters'] = np.load(probe_path / 'spikes.clusters.npy')
+    spikes['amps'] = np.load(probe_path / 'spikes.amps.npy')
+    spikes['depths'] = np.load(probe_path / 'spikes.depths.npy')
     
     # Load in cluster data
     clusters = dict()
-    clusters['channels'] = np.load(join(session_path, probe, 'clusters.channels.npy'))
-    clusters['depths'] = np.load(join(session_path, probe, 'clusters.depths.npy'))
-    clusters['amps'] = np.load(join(session_path, probe, 'clusters.amps.npy'))
+    clusters['channels'] = np.load(probe_path / 'clusters.channels.npy')
+    clusters['depths'] = np.load(probe_path / 'clusters.depths.npy')
+    clusters['amps'] = np.load(probe_path / 'clusters.amps.npy')
     clusters['cluster_id'] = np.arange(clusters['channels'].shape[0])
     
     # Add cluster qc metrics
-    if isfile(join(session_path, probe, 'clusters.bcUnitType.npy')):
-        clusters['bc_label'] = np.load(join(session_path, probe, 'clusters.bcUnitType.npy'),
+    if (probe_path / 'clusters.bcUnitType.npy').is_file():
+        clusters['bc_label'] = np.load(probe_path / 'clusters.bcUnitType.npy',
                                        allow_pickle=True)
-    clusters['ks_label'] = pd.read_csv(join(session_path, probe, 'cluster_KSLabel.tsv'),
-                                       sep='\t')['KSLabel']
-    if isfile(join(session_path, probe, 'clusters.iblLabel.tsv')):
-        clusters['ibl_label'] = pd.read_csv(join(session_path, probe, 'cluster_IBLLabel.tsv'),
-                                            sep='\t')['ibl_label']
-    if isfile(join(session_path, probe, 'cluster_group.tsv')):
-        clusters['manual_label'] = pd.read_csv(join(session_path, probe, 'cluster_group.tsv'),
-                                               sep='\t')['group']
+    clusters['ks_label'] = pd.read_csv(probe_path / 'cluster_KSLabel.tsv', sep='\t',
+                                       engine='pyarrow', usecols=['KSLabel'])['KSLabel']
+    if (probe_path / 'clusters.iblLabel.tsv').is_file():
+        clusters['ibl_label'] = pd.read_csv(probe_path / 'cluster_IBLLabel.tsv', sep='\t',
+                                            engine='pyarrow', usecols=['ibl_label'])['ibl_label']
+    if (probe_path / 'cluster_group.tsv').is_file():
+        clusters['manual_label'] = pd.read_csv(probe_path / 'cluster_group.tsv', sep='\t',
+                                               engine='pyarrow', usecols=['group'])['group']
     # Load in channel data
     channels = dict()
     if histology:
-        if not isfile(join(session_path, probe, 'channel_locations.json')):
+        if not (probe_path / 'channel_locations.json').is_file():
             raise Exception('No aligned channel locations found! Set histology to False to load data without brain regions.')
         
         # Load in alignment GUI output
-        f = open(join(session_path, probe, 'channel_locations.json'))
+        f = open(probe_path / 'channel_locations.json')
         channel_locations = json.load(f)
         f.close()
         
@@ -647,7 +838,7 @@ def load_neural_data(session_path, probe, histology=True, only_good=True):
         clusters['acronym'] = channels['acronym'][clusters['channels']]
             
     # Load in the local coordinates of the probe
-    local_coordinates = np.load(join(session_path, probe, 'channels.localCoordinates.npy'))  
+    local_coordinates = np.load(probe_path / 'channels.localCoordinates.npy')  
     channels['lateral_um'] = local_coordinates[:, 0]
     channels['axial_um'] = local_coordinates[:, 1]
         
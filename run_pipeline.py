@@ -4,87 +4,271 @@ Written by Guido Meijer
 
 """
 
-from powerpixels import Pipeline
-
 import os
-from os.path import join, split, isdir
+import shutil
+import threading
+import json
+from os.path import join, exists
 import numpy as np
 from datetime import datetime
-from glob import glob
 from pathlib import Path
+from fnmatch import fnmatch
+from collections import deque
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 
+# Folders which never contain a process_me.flag, no need to look inside them
+SKIP_DIRS = ['raw_ephys_data', 'kilosort*', 'sorter_output', 'probe0*']
 
-def run_pipeline():
 
-    # Initialize power pixels pipeline
-    pp = Pipeline()
-        
-    # Search for process_me.flag
-    print('Looking for process_me.flag..')
-    for root, directory, files in os.walk(pp.settings['DATA_FOLDER']):
-        if 'process_me.flag' in files:
-            print(f'\nStarting pipeline in {root} at {datetime.now().strftime("%H:%M")}\n')
-            
-            # Set session path
-            pp.session_path = Path(root)
-            
-            # Restructure file and folders
-            pp.restructure_files()
-                   
-            # Create nidq synchronization files
-            pp.nidq_synchronization()
-            
-            # Loop over multiple probes 
-            probes = glob(join(root, 'raw_ephys_data', 'probe*'))
-            probe_done = np.zeros(len(probes)).astype(bool)
-            for i, probe_path in enumerate(probes):
-                print(f'\nStarting preprocessing of {split(probe_path)[-1]}')
-                
-                # Set probe paths
-                pp.set_probe_paths(Path(probe_path))
-                
-                # Check if probe is already processed
-                if isdir(join(pp.session_path, pp.this_probe + pp.settings['IDENTIFIER'])):
-                    print('Probe already processed, moving on')
-                    probe_done[i] = True
+def find_flagged_sessions(root):
+    """
+    Search the data folder for sessions with a process_me.flag using a breadth-first scan.
+    Folders that never contain a flag (raw data, sorter output) are not descended into and
+    the search does not continue inside a flagged session.
+
+    Parameters
+    ----------
+    root : str
+        Path to the top-level data folder.
+
+    Yields
+    ------
+    str
+        Path to a session folder which contains a process_me.flag
+
+    """
+    
+    if exists(join(root, 'process_me.flag')):
+        yield root
+        return
+    
+    queue = deque([root])
+    while queue:
+        try:
+            entries = os.scandir(queue.popleft())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
                     continue
-                
-                # Preprocessing
-                rec = pp.preprocessing()
-                
-                # Spike sorting
-                print(f'\nStarting {split(probe_path)[-1]} spike sorting at {datetime.now().strftime("%H:%M")}')
-                sort = pp.spikesorting(rec, probe_path)   
-                if sort is None:
-                    print('Spike sorting failed!')
+                if any(fnmatch(entry.name, pattern) for pattern in SKIP_DIRS):
                     continue
-                print(f'Detected {sort.get_num_units()} units\n')      
-                                       
-                # Create sorting analyzer for manual curation in SpikeInterface and save to disk
-                pp.neuron_metrics(sort, rec)
-                
-                # Calculate raw ephys QC metrics
-                pp.raw_ephys_qc()
-                
-                # Convert Kilosort output to ALF file format and move to results folder
-                pp.convert_to_alf()
-                
-                # Add indication if neurons are good from several sources to the quality metrics
-                pp.automatic_curation()
-                
-                # Synchronize spike sorting to the nidq clock
-                pp.probe_synchronization()
+                if exists(join(entry.path, 'process_me.flag')):
+                    yield entry.path
+                else:
+                    queue.append(entry.path)
+
+
+def remove_folder_async(folder_path):
+    """
+    Delete a folder in a background thread, deleting multi-GB files can take a while on network 
+    drives and the next steps of the pipeline don't need to wait for it.
+
+    Parameters
+    ----------
+    folder_path : Path
+        Path to the folder to delete.
+
+    Returns
+    -------
+    thread : Thread
+        The thread which is deleting the folder.
+
+    """
+    thread = threading.Thread(target=shutil.rmtree, args=(folder_path,),
+                              kwargs=dict(onerror=_log_remove_error))
+    thread.start()
+    return thread
+
+
+def _log_remove_error(function, path, exc_info):
+    print(f'Could not delete {path} ({exc_info[1]}), delete manually')
+
+
+def session_needs_processing(session_path, identifier):
+    """
+    Quick check whether a flagged session still has probes that need to be processed.
+
+    Parameters
+    ----------
+    session_path : Path
+        Path to the session folder.
+    identifier : str
+        The IDENTIFIER from the settings which is appended to the probe output folders.
+
+    Returns
+    -------
+    bool
+        False when all probes have an output folder, True otherwise (also when the raw data
+        has not been restructured into probe folders yet).
+
+    """
+    probes = list(session_path.joinpath('raw_ephys_data').glob('probe*'))
+    if len(probes) == 0:
+        return True
+    return any(not (session_path / (probe.name + identifier)).is_dir() for probe in probes)
+
+
+# Pipeline object of a worker process, initialized once per worker by _init_worker
+_worker_pp = None
+
+
+def _init_worker(n_jobs):
+    from powerpixels import Pipeline
+    global _worker_pp
+    
+    # The ONE setup writes to the shared ONE parameter and cache files, it is done once in the
+    # main process so that the workers don't race each other on these files
+    _worker_pp = Pipeline(n_jobs=n_jobs, init_one=False)
+
+
+def resolve_n_cores(n_cores):
+    """
+    Convert the N_CORES setting to a number of cores, -1 means all cores and other negative 
+    values count back from all cores (-2 is all but one).
+
+    """
+    if n_cores < 0:
+        n_cores = os.cpu_count() + 1 + n_cores
+    return max(1, n_cores)
+    
+
+def process_probe(probe_path, session_path, gpu_sem):
+    """
+    Run the full pipeline on a single probe, runs in a worker process so that multiple probes
+    can be preprocessed in parallel.
+
+    Parameters
+    ----------
+    probe_path : Path
+        Path to the raw data folder of the probe.
+    session_path : str
+        Path to the session folder.
+    gpu_sem : Semaphore
+        Shared semaphore which makes sure only one probe at a time is spike sorted on the GPU.
+
+    Returns
+    -------
+    bool
+        Whether the probe is done processing.
+
+    """
+    
+    pp = _worker_pp
+    pp.session_path = Path(session_path)
+    
+    # Set probe paths
+    pp.set_probe_paths(Path(probe_path))
+    print(f'\nStarting preprocessing of {pp.this_probe}')
+    
+    # Check if probe is already processed
+    if pp.results_path.is_dir():
+        print('Probe already processed, moving on')
+        return True
+    
+    # Preprocessing
+    rec = pp.preprocessing()
+    
+    # Spike sorting, only one probe at a time can use the GPU. The binary file for the sorter is
+    # written inside the semaphore as well so that at most two binary files exist at the same
+    # time (the one being sorted and the one of the previous probe until it is deleted below)
+    with gpu_sem:
+        rec_bin = pp.save_binary(rec)
+        print(f'\nStarting {pp.this_probe} spike sorting at {datetime.now().strftime("%H:%M")}')
+        sort = pp.spikesorting(rec_bin, pp.probe_path)   
+    if sort is None:
+        print('Spike sorting failed!')
+        del rec, rec_bin
+        remove_folder_async(pp.probe_path / 'preproc_bin')
+        return False
+    print(f'Detected {sort.get_num_units()} units\n')      
+                           
+    # Create sorting analyzer for manual curation in SpikeInterface and save to disk, this uses 
+    # the lazy preprocessing chain on the raw data so that the analyzer keeps access to the 
+    # traces after the binary file is deleted
+    pp.neuron_metrics(sort, rec)
+    
+    # Delete the binary file of the preprocessed recording in the background
+    del rec, rec_bin, sort
+    remove_folder_async(pp.probe_path / 'preproc_bin')
+    
+    # Calculate raw ephys QC metrics
+    pp.raw_ephys_qc()
+    
+    # Convert Kilosort output to ALF file format and move to results folder
+    pp.convert_to_alf()
+    
+    # Add indication if neurons are good from several sources to the quality metrics
+    pp.automatic_curation()
+    
+    # Synchronize spike sorting to the nidq clock
+    pp.probe_synchronization()
+    
+    # Compress raw data (still hase issues, don't run)
+    pp.compress_raw_data()            
                 
-                # Compress raw data (still hase issues, don't run)
-                pp.compress_raw_data()            
-                            
-                probe_done[i] = True
-                print(f'Done! At {datetime.now().strftime("%H:%M")}')
+    print(f'Done! At {datetime.now().strftime("%H:%M")}')
+    return True
+
+
+def run_pipeline():
+    
+    # Load in settings, deliberately separate from Pipeline so that powerpixels (and with it 
+    # SpikeInterface and ONE) is only imported when there is something to process
+    with open(Path(__file__).resolve().parent / 'settings.json', 'r') as openfile:
+        settings = json.load(openfile)
+        
+    # Search for process_me.flag and check which sessions still have probes to process
+    print('Looking for process_me.flag..')
+    sessions = []
+    for root in find_flagged_sessions(settings['DATA_FOLDER']):
+        if session_needs_processing(Path(root), settings['IDENTIFIER']):
+            sessions.append(root)
+        else:
+            print(f'All probes in {root} are already processed, removing process_me.flag')
+            os.remove(join(root, 'process_me.flag'))
+    
+    # Only initialize the pipeline when there is something to process
+    if len(sessions) == 0:
+        print('No sessions to process')
+        return
+    from powerpixels import Pipeline
+    pp = Pipeline()
+    
+    # Semaphore to serialize spike sorting over the probe worker processes
+    manager = mp.Manager()
+    gpu_sem = manager.Semaphore(1)
+        
+    for root in sessions:
+        print(f'\nStarting pipeline in {root} at {datetime.now().strftime("%H:%M")}\n')
+        
+        # Set session path
+        pp.session_path = Path(root)
+        
+        # Restructure file and folders
+        pp.restructure_files()
+               
+        # Create nidq synchronization files
+        pp.nidq_synchronization()
+        
+        # Process multiple probes in parallel, one worker per probe and the cores in N_CORES 
+        # divided over the workers
+        probes = list(pp.session_path.joinpath('raw_ephys_data').glob('probe*'))
+        n_cores = resolve_n_cores(settings['N_CORES'])
+        n_workers = max(1, min(len(probes), n_cores))
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(max(1, n_cores // n_workers),)) as executor:
+            futures = [executor.submit(process_probe, probe_path, root, gpu_sem)
+                       for probe_path in probes]
+            probe_done = np.array([future.result() for future in futures]).astype(bool)
+        
+        # Delete process_me.flag if all probes are processed
+        if np.sum(probe_done) == len(probes):
+            os.remove(pp.session_path / 'process_me.flag')
             
-            # Delete process_me.flag if all probes are processed
-            if np.sum(probe_done) == len(probes):
-                os.remove(os.path.join(root, 'process_me.flag'))
-                
+    manager.shutdown()
     return
 
 